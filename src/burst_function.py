@@ -4,23 +4,48 @@ from constants import *
 from pulse_profiles import GaussianExp
 
 
+# Timing offset of each pulse within a group of four, indexed by n mod 4.
+_TAU_LUT = np.array([0.0, TAU_1, TAU_2, TAU_3])
+
+# Maximum number of pulse matrix elements evaluated at once.
+_BLOCK_SIZE = 1 << 16
+
+
 class BurstFunction:
     """
     Class defining the parameters of the burst shape function. Includes timing
     information, and functionality for producing a regression matrix.
+
+    `dtype` sets the precision of the regression matrix. Single precision 
+    (np.float32) is ample for 8-bit scope data, and halves the memory used by
+    the matrix and the memory traffic of solving the regression.
     """
-    def __init__(self, t_0: float, n_pulses: int, 
-                 pulse_type: TraceType) -> None:
+    def __init__(self, t_0: float, n_pulses: int, pulse_type: TraceType,
+                 dtype: np.dtype = np.float64) -> None:
         self._t0 = t_0
         self._n_pulses = n_pulses
+        self.dtype = np.dtype(dtype)
         
         self.ptype = pulse_type
         self.pulse_shape = GaussianExp(PULSE_PARAM_IDX[pulse_type])
 
+        # Timing values that stay fixed unless t0 or n_pulses are changed.
+        self._total_tshift = t_0 - TRACE_DELAY_IDX[pulse_type]
+        self._pulse_times = self.get_time_from_pulses(np.arange(n_pulses))
+
         self.t_start = self.get_t0() - PULSE_WIDTH / 2
         self.t_end = self.t_start + \
                         self.get_time_from_pulses(self.get_n_pulses())
 
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        # Burst functions pickled by earlier versions of this program lack the
+        # attributes below.
+        if 'dtype' not in state:
+            self.dtype = np.dtype(np.float64)
+        self._total_tshift = self._t0 - TRACE_DELAY_IDX[self.ptype]
+        self._pulse_times = self.get_time_from_pulses(np.arange(self._n_pulses))
+
     def get_t0(self) -> float:
         return self._t0
     
@@ -31,17 +56,19 @@ class BurstFunction:
         if not isinstance(value, float):
             raise ValueError("`value` must be a float.")
         self._t0 = value
+        self._total_tshift = value - TRACE_DELAY_IDX[self.ptype]
 
     def set_n_pulses(self, value: float) -> None:
         if not isinstance(value, int):
             raise ValueError("`value` must be an integer.")
         self._n_pulses = value
+        self._pulse_times = self.get_time_from_pulses(np.arange(value))
 
     def set_pulse_params(self, params):
         if len(params) != self.pulse_shape.param_num:
             raise ValueError(f"Must pass {self.pulse_shape.param_num} "
                              "parameters.")
-        self.pulse_shape.parameters = np.array(params)
+        self.pulse_shape.set_params(np.array(params, dtype=np.float64))
 
     @staticmethod
     def tau_function(n: np.ndarray) -> np.ndarray:
@@ -50,16 +77,11 @@ class BurstFunction:
         in README for how constants TAU_1, TAU_2 and TAU_3 relate to the overall
         timing.
         """
-
-        # Returns 1 if 'value' is congruent to 'n' mod 4, else returns 0.
-        compare_func = lambda value : np.vectorize(lambda x : x == value)
-        compare_func = compare_func(np.mod(n, 4))
-
-        return compare_func(1) * TAU_1 + compare_func(2) * TAU_2 + \
-                compare_func(3) * TAU_3
+        return _TAU_LUT[np.asarray(n) & 3]
 
     def get_time_from_pulses(self, n_vals):
-        return PERIOD * np.floor_divide(n_vals, 4) + self.tau_function(n_vals)
+        n_vals = np.asarray(n_vals)
+        return PERIOD * (n_vals >> 2) + _TAU_LUT[n_vals & 3]
 
     def get_pulse_matrix(self, time_vals) -> np.ndarray:
         """
@@ -71,25 +93,66 @@ class BurstFunction:
         linear regression.
         """
 
-        n_values = np.arange(0, self._n_pulses, 1, dtype=int)
-
-        total_tshift = self._t0 - TRACE_DELAY_IDX[self.ptype]
-        time_values = time_vals[:, None] - total_tshift - \
-                        self.get_time_from_pulses(n_values[None, :])
+        # The pulse shape is evaluated in double precision, like all pulse 
+        # shapes, one block of time values at a time, so that only the full 
+        # matrix is stored as `self.dtype`.
+        block_len = self._block_len()
+        if len(time_vals) <= block_len:
+            return self._eval_pulse_block(time_vals).astype(self.dtype, 
+                                                            copy=False)
+
+        pulse_matrix = np.empty((len(time_vals), self._n_pulses), 
+                                dtype=self.dtype)
+        for start in range(0, len(time_vals), block_len):
+            stop = start + block_len
+            pulse_matrix[start:stop] = \
+                self._eval_pulse_block(time_vals[start:stop])
+        return pulse_matrix
+
+    def _eval_pulse_block(self, time_vals) -> np.ndarray:
+        # Columns are not shifted copies of one another, since the pulse 
+        # spacings are not whole numbers of samples.
+        time_values = time_vals[:, None] - self._total_tshift - \
+                        self._pulse_times[None, :]
 
         pulse_shape_func = self.pulse_shape.norm_pulse_shape
-        return pulse_shape_func(time_values, *self.pulse_shape.parameters)
+        return pulse_shape_func(time_values, *self.pulse_shape.param_tuple)
 
-    def burst_function(self, time_values, amplitudes) -> np.ndarray:
+    def _block_len(self) -> int:
+        """
+        Returns the number of time values in a block of at most `_BLOCK_SIZE`
+        pulse matrix elements.
+        """
+        return max(1, _BLOCK_SIZE // max(1, self._n_pulses))
+
+    def burst_function(self, time_values, amplitudes, 
+                       out: np.ndarray = None) -> np.ndarray:
         """
         Returns the function evaluated on an numpy array of time values.
         Used for plotting mostly. 
+
+        The pulse matrix is evaluated in blocks of time values and summed into
+        the output, so the full (time values x pulses) matrix is never held in
+        memory.
+
+        If given, the result is written into `out`, which must be a contiguous
+        array of the same length as `time_values` and of type `self.dtype`, 
+        so that repeated evaluations can reuse one buffer.
         """
 
-        if len(amplitudes) != self._n_pulses:
+        amplitudes = np.asarray(amplitudes, dtype=self.dtype)
+        if amplitudes.shape[0] != self._n_pulses:
             raise ValueError("Number of amplitudes must equal number of "
                             "pulses.")
-        amplitudes = np.array(amplitudes)
 
-        pulse_val_matrix = self.get_pulse_matrix(time_values)
-        return pulse_val_matrix.dot(amplitudes)
+        if out is None:
+            out = np.empty(len(time_values), dtype=self.dtype)
+        elif out.shape != (len(time_values),):
+            raise ValueError("`out` must have the same length as "
+                             "`time_values`.")
+
+        block_len = self._block_len()
+        for start in range(0, len(time_values), block_len):
+            block = self.get_pulse_matrix(time_values[start:start + block_len])
+            np.dot(block, amplitudes, out=out[start:start + block_len])
+        return out
@@ -23,20 +23,25 @@ class DataTrace:
         self.time_units = time_units
         self.data_units = data_units
 
-        self._current_idx = 0
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        # Traces pickled by earlier versions of this program do not record
+        # whether their time values are sorted.
+        if '_is_sorted' not in state:
+            self.set_time_values(self._time_values)
 
     def __iter__(self):
-        return self
-    
-    def __next__(self) -> tuple[np.ndarray, np.ndarray]:
-        if self._current_idx == self.trace_len:
-            raise StopIteration
-        
-        rval = (self._time_values[self._current_idx], 
-                self._data_values[self._current_idx])
-        self._current_idx += 1
-        
-        return rval
+        """
+        Iterates over (time, data) pairs. Prefer `as_arrays` and operating on
+        the whole arrays wherever possible.
+        """
+        return zip(self._time_values.tolist(), self._data_values.tolist())
+
+    def as_arrays(self) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Returns the time values and data values arrays as a tuple.
+        """
+        return self._time_values, self._data_values
     
     def _set_arr(self, attrname: str, arr: np.ndarray) -> None:
         if np.ndim(arr) != 1:
@@ -48,8 +53,16 @@ class DataTrace:
         Returns a data trace with time and data values restricted between to lie
         `t_start` and `t_end`.
         """
-        idx = np.vectorize(lambda t: t_start <= t <= t_end)(self._time_values)
-        new_times = self._time_values[idx]
+        times = self._time_values
+        if self._is_sorted:
+            # Scope traces are sampled in order, so the window is a contiguous
+            # slice; this returns views instead of fancy-indexed copies.
+            lo = np.searchsorted(times, t_start, side='left')
+            hi = np.searchsorted(times, t_end, side='right')
+            idx = slice(lo, hi)
+        else:
+            idx = (times >= t_start) & (times <= t_end)
+        new_times = times[idx]
         new_data = self._data_values[idx]
         return DataTrace(new_times, new_data, self.time_units, self.data_units)
 
@@ -59,8 +72,18 @@ class DataTrace:
     def get_time_values(self) -> np.ndarray:
         return self._time_values
 
+    def get_time_range(self) -> tuple[float, float]:
+        """
+        Returns the earliest and latest time values of the trace.
+        """
+        times = self._time_values
+        if self._is_sorted:
+            return times[0], times[-1]
+        return np.min(times), np.max(times)
+
     def set_data_values(self, values: np.ndarray) -> None:
         self._set_arr('_data_values', values)
 
     def set_time_values(self, values: np.ndarray) -> None:
         self._set_arr('_time_values', values)
+        self._is_sorted = bool(np.all(values[1:] >= values[:-1]))
@@ -1,15 +1,19 @@
 import numpy as np
-import statsmodels.api as sm
-from scipy.stats import chi2
+import scipy.linalg
+from scipy.special import gammaincc
+from tabulate import tabulate
 
 import logging
-import warnings
+from typing import TYPE_CHECKING, Union
 
 from burst_function import BurstFunction
 from data_trace import DataTrace
 from constants import *
 from logger import add_handlers
 
+if TYPE_CHECKING:
+    from statsmodels.regression.linear_model import RegressionResults
+
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
@@ -23,6 +27,37 @@ class FitQualityWarning(RuntimeWarning):
     pass
 
 
+class FitResults:
+    """
+    Lightweight container for the results of a least squares fit, produced by
+    `Fitter.linear_regress_burst_fast`. Exposes the subset of the attributes of
+    statsmodels' `RegressionResults` that the rest of this program relies on.
+    """
+
+    def __init__(self, params: np.ndarray, data_values: np.ndarray,
+                 fittedvalues: np.ndarray, df_resid: int) -> None:
+        self.params = params
+        self.fittedvalues = fittedvalues
+        self.resid = data_values - fittedvalues
+
+        # The burst model has no constant term, so like statsmodels this uses
+        # the uncentered R^2 value.
+        self.ssr = self.resid.dot(self.resid)
+        self.rsquared = 1 - self.ssr / data_values.dot(data_values)
+        self.nobs = data_values.size
+        self.df_resid = df_resid
+
+    def summary(self) -> str:
+        stats = tabulate([["No. Observations", self.nobs],
+                          ["Df Residuals", self.df_resid],
+                          ["R-squared", f"{self.rsquared:.3f}"]],
+                         headers=["Least Squares Results"], 
+                         disable_numparse=True)
+        params = tabulate(enumerate(self.params), 
+                          headers=["Pulse", "Amplitude"], floatfmt='.4e')
+        return f"{stats}\n\n{params}"
+
+
 class Fitter:
     """
     Class containing fitting methods logic. `name` input parameter is for
@@ -56,7 +91,7 @@ class Fitter:
         self._fit_qual_thresh = thresh
 
     def linear_regress_burst(self, dtrace: DataTrace, 
-                             bfunc: BurstFunction) -> sm.regression.linear_model.RegressionResults:
+                             bfunc: BurstFunction) -> "RegressionResults":
         """
         Performs a linear regression on a data trace with a BurstFunction object
         as the model. Returns the `statsmodels.api.linear_model.RegressionResults` 
@@ -66,17 +101,77 @@ class Fitter:
         parameter in this class.
         """
         
-        time_vals, data_vals = dtrace.get_time_values(), \
-                                   dtrace.get_data_values()
+        # Modules that are slow to import, like statsmodels, matplotlib and 
+        # scipy.optimize, are only imported where they are used throughout 
+        # the program.
+        import statsmodels.api as sm
+
+        time_vals, data_vals = dtrace.as_arrays()
         regressors = bfunc.get_pulse_matrix(time_vals)
         
-        # Perform a linear regression
-        sm.add_constant(regressors)
+        # Perform a linear regression. The burst model has no constant term.
         results = sm.OLS(data_vals, regressors).fit()
         self.results = results
 
         return results
 
+    def linear_regress_burst_fast(self, dtrace: DataTrace, 
+                                  bfunc: BurstFunction) -> FitResults:
+        """
+        Performs the same regression as `linear_regress_burst`, but solves the
+        least squares problem directly with LAPACK instead of going through
+        statsmodels, which computes a large set of auxiliary statistics that are
+        not needed for producing the amplitudes. Returns a `FitResults` object.
+        """
+
+        time_vals, data_vals = dtrace.as_arrays()
+        regressors = bfunc.get_pulse_matrix(time_vals)
+        data_vals = data_vals.astype(regressors.dtype, copy=False)
+
+        coefs, _, rank, _ = scipy.linalg.lstsq(regressors, data_vals, 
+                                               lapack_driver='gelsy')
+        results = FitResults(coefs, data_vals, regressors.dot(coefs), 
+                             df_resid=data_vals.size - rank)
+        self.results = results
+
+        return results
+
+    def linear_regress_burst_batch(self, dtraces: list[DataTrace],
+                                   bfunc: BurstFunction) -> list[FitResults]:
+        """
+        Fits several data traces to the same BurstFunction model at once. All
+        of the traces must share the same time values, so that the regressor 
+        matrix is common to every fit; the data values are then stacked as 
+        columns and solved for in a single least squares call, rather than
+        factoring the regressor matrix once per trace.
+
+        Returns a list of `FitResults` objects, one for each trace. The last 
+        of these is kept as `self.results`.
+        """
+
+        time_vals = dtraces[0].get_time_values()
+        for dtrace in dtraces[1:]:
+            if not np.array_equal(dtrace.get_time_values(), time_vals):
+                raise ValueError("All data traces in a batch regression must "
+                                 "have the same time values.")
+
+        regressors = bfunc.get_pulse_matrix(time_vals)
+        data_vals = np.column_stack([dtrace.get_data_values() 
+                                     for dtrace in dtraces])
+        data_vals = data_vals.astype(regressors.dtype, copy=False)
+
+        coefs, _, rank, _ = scipy.linalg.lstsq(regressors, data_vals, 
+                                               lapack_driver='gelsy')
+        fitted_vals = regressors.dot(coefs)
+
+        df_resid = time_vals.size - rank
+        results = [FitResults(coefs[:, idx], data_vals[:, idx], 
+                              fitted_vals[:, idx], df_resid)
+                   for idx in range(len(dtraces))]
+        self.results = results[-1]
+
+        return results
+
     def evaluate_fit_quality(self):
         if self.results.rsquared < self._fit_qual_thresh:
             raise FitQualityWarning(f"{self.name} R^2={self.results.rsquared:.3f} < "
@@ -85,20 +180,27 @@ class Fitter:
                                     "calling the script with verbose output, "
                                     "or reduce the R^2 threshold value.")
 
-    def get_chi2_stats(self, errs: np.ndarray):
+    def get_chi2_stats(self, errs: Union[float, np.ndarray]):
         """
         Does a chi-squared test on the fit, given uncertainty values for the
-        data.
+        data. `errs` is either an array of uncertainties for each data value,
+        or a single uncertainty shared by all of them.
         """
 
         if self.results is None:
             raise AttributeError("`self.results` is None. Must perform fit "
                                  "before calculating test statistics.")
         
-        chi2_val = np.sum(self.results.resid ** 2 / (errs ** 2))
+        resid = self.results.resid
+        if np.ndim(errs) == 0:
+            chi2_val = resid.dot(resid) / errs**2
+        else:
+            norm_resid = resid / errs
+            chi2_val = norm_resid.dot(norm_resid)
         red_chi2_val = chi2_val / self.results.df_resid
 
-        p_val = 1 - chi2.cdf(chi2_val, df=self.results.df_resid)
+        # Survival function of the chi-squared distribution.
+        p_val = gammaincc(self.results.df_resid / 2, chi2_val / 2)
         return red_chi2_val, p_val
 
     @staticmethod
@@ -106,8 +208,11 @@ class Fitter:
         """
         Returns the coefficient of determination, or R^2 value, of a curve fit.
         """
-        sum_sq_res = np.sum((data_values - function_values)**2)
-        sum_sq_tot = np.sum((data_values - np.mean(data_values))**2)
+        resid = data_values - function_values
+        sum_sq_res = resid.dot(resid)
+
+        deviation = data_values - np.mean(data_values)
+        sum_sq_tot = deviation.dot(deviation)
 
         return 1 - (sum_sq_res / sum_sq_tot)
 
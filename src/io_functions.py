@@ -4,6 +4,8 @@ import os
 import pickle
 import logging
 import datetime
+import tempfile
+from typing import Optional
 
 from data_trace import DataTrace
 from constants import *
@@ -15,6 +17,18 @@ logger.setLevel(logging.DEBUG)
 add_handlers(logger)
 
 
+# Extension of the file holding the array data of a pickled output object.
+PICKLE_BUFFERS_EXT = ".buffers"
+# Byte alignment of each array stored in a pickle buffers file.
+_BUFFER_ALIGN = 64
+# Start of pickle files written by `OutputHandler.pickle_obj`, followed by the
+# format version. Plain pickle files always start with a b"\x80" byte.
+_PICKLE_MAGIC = b"BURSTFIT-PICKLE"
+_PICKLE_VERSION = 1
+# Start time of this run of the program, written at the top of output files.
+_RUN_TIMESTAMP = datetime.datetime.now().isoformat(sep=' ', timespec='seconds')
+
+
 class OutputHandler:
     """
     Class to handle file output operations.
@@ -28,7 +42,7 @@ class OutputHandler:
         )
 
         self.force_overwrites = force_overwrites
-        self.preamble = f"Output generated at {datetime.datetime.now()}\n\n"
+        self.preamble = f"Output generated at {_RUN_TIMESTAMP}\n\n"
 
     def set_file_preamble(self, preamble: str):
         if not isinstance(preamble, str):
@@ -48,8 +62,8 @@ class OutputHandler:
     def save_csv(self, arr: np.ndarray, fname: str, col_headers: list[str]=[], 
                  encoding: str=None):
         """
-        Wrapper for numpy's savetxt function, to save a numpy array to a .csv
-        file.
+        Saves a numpy array to a .csv file, in the same format as numpy's 
+        savetxt function (see `fast_savetxt`).
 
         `col_headers` is a list of names for the columns in the array to be 
         saved. Headers will be saved as comments (i.e. '# ' will be appended
@@ -59,11 +73,11 @@ class OutputHandler:
         outfile = os.path.join(self.fpath, fname)
         self.test_filepath_overwrite(outfile)
         
-        if col_headers is not []:
-            self.preamble += ", ".join(col_headers)
+        header = self.preamble + ", ".join(col_headers)
 
-        np.savetxt(outfile, arr, header=self.preamble, delimiter=',', 
-                   encoding=encoding)
+        with open(outfile, 'w', encoding=encoding) as file:
+            file.write("# " + header.replace("\n", "\n# ") + "\n")
+            fast_savetxt(file, arr)
 
         stream_h.setLevel(logging.INFO)
         logger.info(f"Burst amplitudes saved to '{outfile}'")
@@ -71,22 +85,97 @@ class OutputHandler:
 
     def pickle_obj(self, filename, obj):
         """
-        Pickles an output data object.
+        Pickles an output data object, to be loaded again with 
+        `load_pickled_obj`.
+
+        The data of any numpy arrays in `obj` is written out of band to a 
+        separate file, with `PICKLE_BUFFERS_EXT` appended to the pickle 
+        filename, so that it can be memory-mapped when loaded. The pickle file
+        itself starts with `_PICKLE_MAGIC` and the format version, followed by
+        the layout of the arrays in that file and the pickled object.
         """
         pickle_path = os.path.join(self.fpath, filename)
         try:
             self.test_filepath_overwrite(pickle_path)
+            self.test_filepath_overwrite(pickle_path + PICKLE_BUFFERS_EXT)
         except RuntimeError as err:
             logger.error(err, exc_info=True)
             raise err
         
+        buffers = []
+        obj_bytes = pickle.dumps(obj, protocol=5, 
+                                 buffer_callback=buffers.append)
+
+        layout = []
+        with open(pickle_path + PICKLE_BUFFERS_EXT, 'wb', 
+                  buffering=1 << 20) as file:
+            offset = 0
+            for buffer in buffers:
+                data = buffer.raw()
+                padding = -offset % _BUFFER_ALIGN
+                file.write(bytes(padding))
+                file.write(data)
+                layout.append((offset + padding, data.nbytes))
+                offset += padding + data.nbytes
+
         with open(pickle_path, 'wb') as file:
-            pickle.dump(obj, file)
+            file.write(_PICKLE_MAGIC + bytes([_PICKLE_VERSION]))
+            pickle.dump(layout, file, protocol=pickle.HIGHEST_PROTOCOL)
+            file.write(obj_bytes)
             stream_h.setLevel(logging.INFO)
             logger.info(f"Pickle file saved to '{pickle_path}'")
             stream_h.setLevel(logging.ERROR)
 
 
+def fast_savetxt(fh, arr: np.ndarray, fmt: str='%.18e', delim: str=','):
+    """
+    Writes a 1D or 2D array to the open text file `fh`, producing the same 
+    output as `np.savetxt(fh, arr, fmt, delim)`. The row format string is 
+    built once and applied to every row, rather than savetxt's per-row 
+    format handling.
+    """
+    arr = np.asarray(arr)
+    arr = arr.reshape(arr.shape[0], -1)
+    row_fmt = delim.join([fmt] * arr.shape[1]) + "\n"
+    fh.writelines(row_fmt % tuple(row) for row in arr.tolist())
+
+
+def load_pickled_obj(pickle_path):
+    """
+    Loads an object pickled by `OutputHandler.pickle_obj`. Array data is 
+    memory-mapped from the accompanying buffers file rather than read into
+    memory, so arrays in the returned object are read-only. Plain pickle 
+    files, written by earlier versions of this program, are loaded normally.
+
+    WARNING: Only use this on pickle files that are known to be generated by 
+    this program; pickle is vulnerable to arbitrary code execution.
+    """
+    buffers_path = pickle_path + PICKLE_BUFFERS_EXT
+
+    with open(pickle_path, 'rb') as file:
+        header = file.read(len(_PICKLE_MAGIC) + 1)
+        if not header.startswith(_PICKLE_MAGIC):
+            file.seek(0)
+            return pickle.load(file)
+
+        if header[-1] != _PICKLE_VERSION:
+            raise ValueError(f"'{pickle_path}' was written in pickle format "
+                             f"version {header[-1]}, which this version of "
+                             "the program cannot read.")
+        if not os.path.exists(buffers_path):
+            raise FileNotFoundError(f"The array data of '{pickle_path}' is "
+                                    f"missing; it is stored in "
+                                    f"'{buffers_path}', which must be kept "
+                                    "alongside the pickle file.")
+
+        layout = pickle.load(file)
+        buffers = []
+        if layout:
+            mapped = np.memmap(buffers_path, dtype=np.uint8, mode='r')
+            buffers = [mapped[start:start + size] for start, size in layout]
+        return pickle.load(file, buffers=buffers)
+
+
 class Loader:
     """
     Abstract class to handle loading functionality for a certain data trace 
@@ -109,14 +198,142 @@ class LeCroyLoader(Loader):
         super().__init__()
 
     @staticmethod
-    def load_trace(fpath) -> DataTrace:
+    def load_trace(fpath, use_cache: bool = True) -> DataTrace:
+        """
+        Loads a trace from a LeCroy .csv file. 
+        
+        Parsing text is slow, so unless `use_cache` is False the parsed values
+        are saved to a '.npy' file next to the .csv file, which is loaded 
+        instead on later calls as long as the .csv file still has the same 
+        size and modification time. The cached values are memory-mapped 
+        rather than read into memory, so the arrays of the returned trace are
+        read-only.
+        """
         if not ".csv" in fpath:
             err =  ValueError("Input file must be a .csv file.")
             logger.error(err, exc_info=True)
             raise err
 
-        time_values, data_values = np.loadtxt(fpath, delimiter=',', skiprows=5,
-                                              unpack=True)
-        logger.info("Data loaded from '%s'" % fpath)
+        cache_path = fpath + ".npy"
+        csv_stat = os.stat(fpath)
+        stamp = np.array([csv_stat.st_size, csv_stat.st_mtime_ns], 
+                         dtype=np.int64)
+
+        trace_arr = None
+        if use_cache:
+            trace_arr = LeCroyLoader._load_cache(cache_path, stamp)
+
+        if trace_arr is None:
+            time_values, data_values = LeCroyLoader._parse_csv(fpath)
+            logger.info("Data loaded from '%s'" % fpath)
+            if not use_cache:
+                return DataTrace(time_values, data_values, 
+                                 time_units="s", data_units="V")
+
+            try:
+                LeCroyLoader._save_cache(cache_path, stamp, time_values, 
+                                         data_values)
+            except OSError as err:
+                logger.warning("Could not cache trace to '%s': %s" 
+                               % (cache_path, err))
+            else:
+                trace_arr = LeCroyLoader._load_cache(cache_path, stamp)
+
+            if trace_arr is None:
+                return DataTrace(time_values, data_values, 
+                                 time_units="s", data_units="V")
+        else:
+            logger.info("Data loaded from cache '%s'" % cache_path)
+
+        # Memory-mapped trace data that is not in use can be paged out, which
+        # keeps memory use low when many traces are held at once.
+        time_values, data_values = trace_arr
         return DataTrace(time_values, data_values, 
                          time_units="s", data_units="V")
+
+    @staticmethod
+    def _load_cache(cache_path, stamp: np.ndarray) -> Optional[np.ndarray]:
+        """
+        Returns the time and data values memory-mapped from the cache file at 
+        `cache_path`, as plain ndarray views of the map, or None if there is
+        no cache file or it was not made from the .csv file described by
+        `stamp`, the size and modification time (in ns) of the .csv file.
+        """
+        try:
+            cached = np.load(cache_path, mmap_mode='r')
+        except (OSError, ValueError):
+            return None
+
+        if (cached.dtype != np.float64 or cached.ndim != 2 or 
+                cached.shape[0] != 2 or cached.shape[1] < 1):
+            return None
+        if not np.array_equal(cached[:, 0].view(np.int64), stamp):
+            return None
+        return np.asarray(cached)[:, 1:]
+
+    @staticmethod
+    def _save_cache(cache_path, stamp: np.ndarray, time_values: np.ndarray, 
+                    data_values: np.ndarray) -> None:
+        """
+        Saves the trace values to the cache file at `cache_path`. The file is
+        written under a temporary name and then moved into place, so that
+        other processes never load a partly written cache file.
+        """
+        # The first column holds `stamp`, stored as int64, and the rest hold
+        # the time and data values.
+        cache_arr = np.empty((2, len(time_values) + 1), dtype=np.float64)
+        cache_arr[:, 0].view(np.int64)[:] = stamp
+        cache_arr[0, 1:] = time_values
+        cache_arr[1, 1:] = data_values
+
+        cache_dir, cache_name = os.path.split(cache_path)
+        fd, tmp_path = tempfile.mkstemp(suffix=".tmp", prefix=cache_name, 
+                                        dir=cache_dir or None)
+        try:
+            with os.fdopen(fd, 'wb') as file:
+                np.save(file, cache_arr)
+            os.replace(tmp_path, cache_path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+    @staticmethod
+    def _parse_csv(fpath) -> tuple[np.ndarray, np.ndarray]:
+        # Uses the fastest reader installed. The readers are imported here 
+        # rather than at the top of the module, since they are slow to import
+        # and only needed when a trace is not cached yet.
+        try:
+            # pyarrow is optional; its multithreaded CSV reader is used in 
+            # place of pandas when it is installed.
+            import pyarrow as pa
+            import pyarrow.csv as pa_csv
+        except ImportError:
+            pass
+        else:
+            columns = ['f0', 'f1']
+            with pa.memory_map(fpath) as source:
+                table = pa_csv.read_csv(
+                    source,
+                    read_options=pa_csv.ReadOptions(
+                        skip_rows=5, autogenerate_column_names=True),
+                    convert_options=pa_csv.ConvertOptions(
+                        column_types={col: pa.float64() for col in columns},
+                        include_columns=columns)
+                )
+            return tuple(table.column(col).to_numpy() for col in columns)
+
+        try:
+            import pandas as pd
+        except ImportError:
+            # Without pandas, CSV reading falls back to numpy's C based 
+            # loadtxt (numpy >= 1.23).
+            trace_arr = np.loadtxt(fpath, delimiter=',', skiprows=5, 
+                                   usecols=(0, 1), dtype=np.float64)
+        else:
+            # Scope traces never contain missing values, so pandas' NA 
+            # detection is skipped.
+            trace_arr = pd.read_csv(fpath, skiprows=5, header=None, 
+                                    usecols=[0, 1], dtype=np.float64, 
+                                    engine='c', na_filter=False, 
+                                    memory_map=True).to_numpy()
+        return trace_arr[:, 0], trace_arr[:, 1]
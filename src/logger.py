@@ -1,42 +1,110 @@
 """
 This file manages the logging functionality for the program. This program logs
-both to stdout, and to a rotating log file.
+both to stdout, and to a rotating log file. Writing the log file can be 
+disabled by setting the environment variable LOG_DISABLE=1.
 """
 
 import logging
-from logging.handlers import RotatingFileHandler
+from logging.handlers import RotatingFileHandler, QueueHandler, QueueListener
+from typing import Optional
 import configparser
+import contextlib
+import functools
+import multiprocessing
 import os
 
 
-conf = configparser.ConfigParser()
-conf.read("conf.conf")
-
 stream_h = logging.StreamHandler()
-
-if not os.path.isdir('logs'):
-    os.mkdir('logs')
-
-# TODO: If user changes name of logfile, delete existing logs with previous
-# name; promp user if they want to do this.
-# TODO: Make it so that the log from a single run of the program does not
-# get split over multiple files when rollover occurs (how to do this???)
-log_fname = os.path.splitext(conf['logfile']['log_file_name'])[0]
-file_h = RotatingFileHandler(f"logs/{log_fname}.log", 
-                             maxBytes=conf.getint('logfile', 'max_bytes'),
-                             backupCount=conf.getint('logfile', 'backup_count'),
-                             encoding="utf-8")
-
 stream_h.setLevel(logging.WARN)
-file_h.setLevel(logging.INFO)
 
 formatter = logging.Formatter(fmt="[%(asctime)s - %(levelname)s]: %(message)s "
                               "(%(name)s line %(lineno)d)",
                               datefmt="%Y-%m-%d %H:%M:%S")
 stream_h.setFormatter(formatter)
-file_h.setFormatter(formatter)
+
+# Read relative to the working directory, like the pulse parameter files.
+_CONF_PATH = "conf.conf"
+
+# Handler used in place of the log file handler in worker processes (see 
+# `log_to_queue`).
+_queue_h = None
+
+
+@functools.lru_cache(maxsize=1)
+def _init_handlers_once() -> Optional[RotatingFileHandler]:
+    """
+    Reads the log file configuration and creates the log file handler, the 
+    first time it is called, and returns the same handler on later calls. 
+    The log file itself is only opened once something is logged to it.
+
+    Returns None if the log file is disabled by setting the environment 
+    variable LOG_DISABLE=1.
+    """
+    if os.environ.get("LOG_DISABLE") == "1":
+        return None
+
+    conf = configparser.ConfigParser()
+    conf.read(_CONF_PATH)
+
+    os.makedirs('logs', exist_ok=True)
+
+    # TODO: If user changes name of logfile, delete existing logs with previous
+    # name; promp user if they want to do this.
+    # TODO: Make it so that the log from a single run of the program does not
+    # get split over multiple files when rollover occurs (how to do this???)
+    log_fname = os.path.splitext(conf['logfile']['log_file_name'])[0]
+    file_h = RotatingFileHandler(f"logs/{log_fname}.log", 
+                                 maxBytes=conf.getint('logfile', 'max_bytes'),
+                                 backupCount=conf.getint('logfile', 
+                                                         'backup_count'),
+                                 encoding="utf-8", delay=True)
+    file_h.setLevel(logging.INFO)
+    file_h.setFormatter(formatter)
+    return file_h
 
 
 def add_handlers(logger: logging.Logger):
+    file_h = _queue_h or _init_handlers_once()
     logger.addHandler(stream_h)
-    logger.addHandler(file_h)
+    if file_h is not None:
+        logger.addHandler(file_h)
+
+
+@contextlib.contextmanager
+def file_log_queue():
+    """
+    Context manager yielding a queue for worker processes to log to (see 
+    `log_to_queue`). Records put on the queue are written to the log file by
+    this process, since a rotating log file cannot be shared between 
+    processes.
+    """
+    file_h = _init_handlers_once()
+    queue = multiprocessing.Queue()
+    listener = QueueListener(queue, *[h for h in [file_h] if h is not None],
+                             respect_handler_level=True)
+    listener.start()
+    try:
+        yield queue
+    finally:
+        listener.stop()
+        queue.close()
+
+
+def log_to_queue(queue) -> None:
+    """
+    Sends the records of every logger that writes to the log file to `queue`
+    instead. Used as the initializer of worker processes, with a queue from
+    `file_log_queue`.
+    """
+    global _queue_h
+
+    file_h = _init_handlers_once()
+    if file_h is None:
+        return
+
+    _queue_h = QueueHandler(queue)
+    _queue_h.setLevel(file_h.level)
+    for logger in logging.Logger.manager.loggerDict.values():
+        if isinstance(logger, logging.Logger) and file_h in logger.handlers:
+            logger.removeHandler(file_h)
+            logger.addHandler(_queue_h)
@@ -2,20 +2,18 @@ import argparse
 from typing import Any
 import numpy as np
 from tabulate import tabulate
-import matplotlib.pyplot as plt
-import statsmodels.api as sm
-from statsmodels.regression.linear_model import RegressionResultsWrapper
 
 import os, sys
-import pickle
+import csv
+import contextlib
 import logging
+from concurrent.futures import ProcessPoolExecutor
 
 from io_functions import *
-from fitter import Fitter, FitQualityWarning
+from fitter import Fitter, FitResults, FitQualityWarning
 from burst_function import BurstFunction
-from plotting import plot_graphs_together
 from constants import *
-from logger import add_handlers, stream_h
+from logger import add_handlers, stream_h, file_log_queue, log_to_queue
 
 
 logger = logging.getLogger(__name__)
@@ -34,16 +32,30 @@ class NoT0Val:
             raise RuntimeError("Do not instantiate this class more than once.")
 
 
+def _stem(path: str) -> str:
+    """
+    Returns the name of the file at `path`, without its directory or extension.
+    """
+    return os.path.splitext(os.path.basename(path))[0]
+
+
 def fit_trace(filepath: str, t0_value: float, n_pulses: int, ptype: TraceType,
-              show_fig=False, verbose_output=False):
+              show_fig=False, verbose_output=False, show_fail_fig=True):
     """
     Performs the operation of loading in data, and fitting it to a burst of
     pulses.
 
-    Returns a dictionary containig a RegressionResultsWrapper produced by
-    statsmodels, keyed with 'fit_results', a copy of the initial data trace
-    object, keyed with 'data_trc', and a copy of the burst function object
-    used to make the fit, keyed with 'burst_model'.
+    If the fit fails the quality check, a `FitQualityWarning` is raised, 
+    after showing the fit if `show_fail_fig` is set. The arguments to 
+    `show_figures` for the failed fit are attached to the error as 
+    `figure_args`, so that the fit can be shown by the caller instead.
+
+    Returns a dictionary containig the fit results, keyed with 'fit_results',
+    a copy of the initial data trace object, keyed with 'data_trc', and a 
+    copy of the burst function object used to make the fit, keyed with 
+    'burst_model'. The fit results are a RegressionResultsWrapper produced by
+    statsmodels if `verbose_output` is set, so that the full regression 
+    summary can be shown, and otherwise a lighter `FitResults` object.
     """
     
     """
@@ -60,27 +72,32 @@ def fit_trace(filepath: str, t0_value: float, n_pulses: int, ptype: TraceType,
     bfunc = BurstFunction(t0_value, n_pulses, ptype)
     res_data_trc = data_trc.make_restricted(bfunc.t_start, bfunc.t_end)
 
-    fname = os.path.splitext(os.path.split(filepath)[-1])[0]
+    fname = _stem(filepath)
     fitter = Fitter(name=fname)
 
     try:
-        fit = fitter.linear_regress_burst(res_data_trc, bfunc)
+        if verbose_output:
+            fit = fitter.linear_regress_burst(res_data_trc, bfunc)
+        else:
+            fit = fitter.linear_regress_burst_fast(res_data_trc, bfunc)
         fitter.evaluate_fit_quality()
 
     except FitQualityWarning as err:
         # If a fit quality error is raised, display the plot of the
         # fit before throwing the exception.
-        show_figures(data_trc, fit, bfunc, fname)
+        figure_args = (data_trc, fit, bfunc, fname)
+        if show_fail_fig:
+            show_figures(*figure_args)
         logger.error(err, exc_info=True)
-        raise FitQualityWarning(err)
+        fail = FitQualityWarning(err)
+        fail.figure_args = figure_args
+        raise fail
 
     # `uval` is taken as the uncertainty estimate for the scope trace values,
     # and it is the maximum voltage value read by the scope before the first
     # pulse in "C1trc00000.csv" from June 14, 2023.
     uval = 0.001167
-    chi2_res, p_val = fitter.get_chi2_stats(
-        np.ones(res_data_trc.trace_len) * uval
-    )
+    chi2_res, p_val = fitter.get_chi2_stats(uval)
 
     if verbose_output:
         print("\n\n")
@@ -98,6 +115,8 @@ def fit_trace(filepath: str, t0_value: float, n_pulses: int, ptype: TraceType,
 
 
 def show_figures(data_trc, fit, bfunc, fname):
+    import matplotlib.pyplot as plt
+    from plotting import plot_graphs_together
 
     fig, _, _, _ = plot_graphs_together(data_trc, fit, bfunc)
 
@@ -107,6 +126,22 @@ def show_figures(data_trc, fit, bfunc, fname):
 
 
 
+def _fit_one(job: tuple):
+    """
+    Fits one file of a batch. `job` is a tuple of the filename, whether to 
+    keep the full fit, and the arguments to `fit_trace`. Defined at module
+    level so that it can be sent to worker processes.
+
+    Returns a tuple of the filename, the fitted amplitudes, and the 
+    dictionary returned by `fit_trace` if it is kept, or else None. Failed 
+    fits are not shown here; see `fit_trace` for how to show them.
+    """
+    filename, keep_fit, *fit_args = job
+    trace_fit = fit_trace(*fit_args, show_fail_fig=False)
+    params = trace_fit['fit_results'].params
+    return filename, params, trace_fit if keep_fit else None
+
+
 class CommandHandler(object):
     """
     Singleton class responsible for dispatching the correct method to each
@@ -155,7 +190,7 @@ class CommandHandler(object):
         if args.pickle:
             self.file_handler.pickle_obj("fit-objects.pickle", fit_dict)
 
-        fname = os.path.splitext(os.path.split(args.filepath)[-1])[0]
+        fname = _stem(args.filepath)
         fname = f"{fname}-amplitudes.csv"
         self.file_handler.save_csv(fit_results.params, fname, 
                                    col_headers=["Amplitudes (V)"], 
@@ -175,15 +210,22 @@ class CommandHandler(object):
         the t0 value will be specified in the command line argument. If the t0
         value is specified both in the manifest file and the command line, an
         error will be raised; similarly if neither are specified.
+
+        Whitespace around values, blank lines, and anything after a '#' on a
+        line (comments) are ignored in the manifest file.
         """
 
-        metadata = np.loadtxt(args.file_manifest, delimiter=',', unpack=True,
-                            dtype=str, encoding='utf-8')
+        with open(args.file_manifest, newline='', encoding='utf-8') as file:
+            lines = (line.partition('#')[0] for line in file)
+            rows = [[field.strip() for field in row] 
+                    for row in csv.reader(lines) if ''.join(row).strip()]
+        metadata = list(zip(*rows))
         if args.get_t0_from_meta:
             fnames, ttypes, t0_vals = metadata
             if not isinstance(args.t0_value, NoT0Val):
                 raise ValueError("Cannot specify t0 values in the manifest file "
                                 "and the command line at the same time.")
+            t0_arr = np.asarray(t0_vals, dtype=np.float64)
         else:
             fnames, ttypes = metadata
             if isinstance(args.t0_value, NoT0Val):
@@ -192,33 +234,64 @@ class CommandHandler(object):
 
         logger.info(f"Fitting batch from {args.data_path}")
         
-        fits = {}
-        amplitdes = []
+        ttype_map = {member.name: member for member in TraceType}
+        unknown_ttypes = set(ttypes) - ttype_map.keys()
+        if unknown_ttypes:
+            raise ValueError(f"Unknown trace types {sorted(unknown_ttypes)} in "
+                             "the manifest file; must be one of "
+                             f"{list(ttype_map)}.")
+
+        jobs = []
         for idx, (filename, ttype) in enumerate(zip(fnames, ttypes)):
 
             t0_val = args.t0_value
             if args.get_t0_from_meta:
-                t0_val = float(t0_vals[idx])
+                t0_val = t0_arr[idx]
 
-            ttype_enum = getattr(TraceType, ttype)
+            ttype_enum = ttype_map[ttype]
             fpath = os.path.join(args.data_path, str(filename))
-
-            trace_fit = fit_trace(fpath, t0_val, args.n_pulses, ttype_enum, 
-                                args.plot, args.verbose)
-            fits[filename] = trace_fit
-            trace_fit = trace_fit['fit_results']
-
-            amplitdes.append(trace_fit.params)
-
-            sys.stdout.write(f"\rFit {idx + 1} / {len(fnames)} completed.")
-            sys.stdout.flush()
+            jobs.append((filename, args.pickle, fpath, t0_val, args.n_pulses, 
+                         ttype_enum, args.plot, args.verbose))
+
+        # Files are fitted independently, so spread them over worker 
+        # processes, unless plotting, since figures can only be shown from the
+        # main process, or printing verbose output, which would be interleaved.
+        # The least squares solver already runs on multithreaded BLAS, so 
+        # only half of the cores are given a worker.
+        n_workers = min(len(jobs), (os.cpu_count() or 1) // 2)
+        fits = {}
+        ampl_arr = np.empty((args.n_pulses, len(fnames)), dtype=np.float64)
+        try:
+            with contextlib.ExitStack() as stack:
+                if args.plot or args.verbose or n_workers <= 1:
+                    results = map(_fit_one, jobs)
+                else:
+                    log_queue = stack.enter_context(file_log_queue())
+                    executor = stack.enter_context(ProcessPoolExecutor(
+                        max_workers=n_workers, initializer=log_to_queue, 
+                        initargs=(log_queue,)))
+                    # On an error, stop without fitting the rest of the batch.
+                    stack.callback(executor.shutdown, cancel_futures=True)
+                    results = executor.map(_fit_one, jobs)
+
+                for idx, (filename, params, trace_fit) in enumerate(results):
+                    if args.pickle:
+                        fits[filename] = trace_fit
+                    ampl_arr[:, idx] = params
+
+                    sys.stdout.write(f"\rFit {idx + 1} / {len(fnames)} "
+                                     "completed.")
+                    sys.stdout.flush()
+
+        except FitQualityWarning as err:
+            show_figures(*err.figure_args)
+            raise
 
         print("\n")
 
         if args.pickle:
             self.file_handler.pickle_obj("fit-objects-dict.pickle", fits)
 
-        ampl_arr = np.column_stack(amplitdes)
         self.file_handler.save_csv(ampl_arr, "trace-amplitudes.csv",
                                    col_headers=fnames, encoding="utf-8")
 
@@ -231,8 +304,10 @@ class CommandHandler(object):
         generated by this program; pickle is vulnerable to arbitrary code execution.
         """
 
-        with open(args.filename, 'rb') as file:
-            results = pickle.load(file)
+        from statsmodels.regression.linear_model import \
+            RegressionResultsWrapper
+
+        results = load_pickled_obj(args.filename)
         
         if args.trace:
             results = results[args.trace]
@@ -240,7 +315,7 @@ class CommandHandler(object):
         try:
             fit, data_trc, bfunc = results.values()
         except AttributeError as err:
-            if isinstance(results, RegressionResultsWrapper):
+            if isinstance(results, (RegressionResultsWrapper, FitResults)):
                 fit = results
                 data_trc = None
                 bfunc = None
@@ -262,6 +337,9 @@ class CommandHandler(object):
             return
 
         if args.plot:
+            import matplotlib.pyplot as plt
+            from plotting import plot_graphs_together
+
             fig, _, _, _ = plot_graphs_together(data_trc, fit, bfunc)
 
             if args.trace:
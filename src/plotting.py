@@ -1,17 +1,21 @@
 import numpy as np
-import matplotlib.pyplot as plt
-import statsmodels.api as sm
-from statsmodels.graphics.gofplots import qqplot
+import functools
+from typing import TYPE_CHECKING
 
 from data_trace import DataTrace
 from burst_function import BurstFunction
- 
 
-def plot_stats_graphs(results: sm.regression.linear_model.RegressionResults,
+if TYPE_CHECKING:
+    from statsmodels.regression.linear_model import RegressionResults
+
+
+def plot_stats_graphs(results: "RegressionResults",
                       fig=None, ax1=None, ax2=None, plot_res_lbf=True):
     """
     Plots a "Residuals vs Fitted" plot, and a normal Q-Q plot of the residuals.
     """
+    import matplotlib.pyplot as plt
+    from statsmodels.graphics.gofplots import qqplot
     
     if not (fig and ax1 and ax2):
         fig, (ax1, ax2) = plt.subplots(1, 2)
@@ -20,9 +24,9 @@ def plot_stats_graphs(results: sm.regression.linear_model.RegressionResults,
              label='Residuals')
 
     if plot_res_lbf:
-        line_best_fit = sm.OLS(results.fittedvalues, results.resid).fit()
-        ax1.plot(results.fittedvalues, line_best_fit.fittedvalues, color='red',
-                 label="Line of best fit")
+        slope, intercept = np.polyfit(results.fittedvalues, results.resid, 1)
+        ax1.plot(results.fittedvalues, slope * results.fittedvalues + intercept, 
+                 color='red', label="Line of best fit")
     ax1.legend()
 
     ax1.set_xlabel("Fitted Values")
@@ -49,18 +53,34 @@ def plot_stats_graphs(results: sm.regression.linear_model.RegressionResults,
     return fig, ax1, ax2
 
 
-def plot_burst_model_trace(ax, times, fit_ampls, bf, **fit_kwargs):
-
-    n_points = 10_000
-    t_start, t_end = np.min(times), np.max(times)
+@functools.lru_cache(maxsize=8)
+def _plot_grid(t_start: float, t_end: float, n_points: int) -> np.ndarray:
+    """
+    Returns `n_points` evenly spaced times from `t_start` to `t_end`. The 
+    grid is cached, since the same one is used for every fit of a batch, so
+    the returned array is read-only.
+    """
     plot_times = np.linspace(t_start, t_end, n_points)
+    plot_times.flags.writeable = False
+    return plot_times
+
+
+def plot_burst_model_trace(ax, t_start, t_end, fit_ampls, bf, n_points=10_000,
+                           **fit_kwargs):
+    """
+    Plots the burst model with amplitudes `fit_ampls` at `n_points` evenly 
+    spaced times from `t_start` to `t_end`. The line is rasterized, since it
+    has far more points than can be seen.
+    """
+    plot_times = _plot_grid(float(t_start), float(t_end), n_points)
     func_vals = bf.burst_function(plot_times, fit_ampls)
-    ax.plot(plot_times, func_vals, **fit_kwargs)
+    ax.plot(plot_times, func_vals, rasterized=True, **fit_kwargs)
 
 
 def plot_fit(data_trc: DataTrace, fit_ampls: np.ndarray, r2_val: float, 
              bf: BurstFunction, data_kwargs: dict = {}, 
              fit_kwargs: dict = {}, fig=None, ax=None) -> None:
+    import matplotlib.pyplot as plt
 
     if not (fig and ax):
         fig, ax = plt.subplots()
@@ -68,9 +88,10 @@ def plot_fit(data_trc: DataTrace, fit_ampls: np.ndarray, r2_val: float,
     times = data_trc.get_time_values()
     ax.plot(times, data_trc.get_data_values(),
             color='black', lw=0, marker='.', label='Data Trace', 
-            **data_kwargs)
+            rasterized=True, **data_kwargs)
 
-    plot_burst_model_trace(ax, times, fit_ampls, bf, 
+    t_start, t_end = data_trc.get_time_range()
+    plot_burst_model_trace(ax, t_start, t_end, fit_ampls, bf, 
                            color='blue', label='Burst Fit', **fit_kwargs)
 
     ax.text(0.01, 0.99, f"$R^2={r2_val:.2f}$", fontsize=12,
@@ -85,6 +106,7 @@ def plot_fit(data_trc: DataTrace, fit_ampls: np.ndarray, r2_val: float,
 
 
 def plot_graphs_together(data_trc, fit, bfunc, plot_res_lbf=True):
+    import matplotlib.pyplot as plt
     
     fig = plt.figure(figsize=(10, 6))
     gs = fig.add_gridspec(2, 2)
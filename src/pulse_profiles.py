@@ -1,6 +1,10 @@
 import numpy as np
 
 
+# Largest argument for which np.exp does not overflow in double precision.
+_MAX_EXP_ARG = np.log(np.finfo(np.float64).max)
+
+
 def rightleft(x : np.ndarray, amp : float, b : float, c1 : float, 
               lam : float, d1 : float, d2 : float) -> np.ndarray:
     """
@@ -16,16 +20,21 @@ def rightleft(x : np.ndarray, amp : float, b : float, c1 : float,
     """
     delta_t = 200e-12
 
-    # Defines which part of the function is defined where.
-    step_function = np.heaviside(x - b - delta_t, amp / 2)
-
     h1 = amp-d1
     h2 = h1 * np.exp(-delta_t**2 / (2 * c1**2)) + d1 - d2
 
-    gaussian = h1 * np.exp(-(x - b)**2 / (2 * c1**2)) + d1
-    exp_tail = h2 * np.exp(-lam * (x - b - delta_t)) + d2
+    # Defines which part of the function is defined where; each part is only
+    # evaluated where it is used.
+    x = np.asarray(x, dtype=np.float64)
+    pulse = np.empty_like(x)
+    before_tail = x < b + delta_t
+    after_tail = ~before_tail
+
+    pulse[before_tail] = (h1 * np.exp(-(x[before_tail] - b)**2 / (2 * c1**2)) 
+                          + d1)
+    pulse[after_tail] = h2 * np.exp(-lam * (x[after_tail] - b - delta_t)) + d2
 
-    return gaussian * (1 - step_function) + exp_tail * step_function
+    return pulse
 
 
 class PulseShape:
@@ -36,6 +45,9 @@ class PulseShape:
     def __init__(self) -> None:
         self.parameters = None
         self.param_num = None
+        # The parameters as a tuple of python floats, which is cheaper to 
+        # unpack into `pulse_shape` calls than an array.
+        self.param_tuple = None
 
     def set_params(self, new_params):
         
@@ -44,6 +56,14 @@ class PulseShape:
                              "for this pulse shape function.")
         
         self.parameters = new_params
+        self.param_tuple = tuple(float(p) for p in new_params)
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        # Recomputes the values derived from the parameters, which pulse 
+        # shapes pickled by earlier versions of this program lack.
+        if self.parameters is not None:
+            self.set_params(self.parameters)
 
     def pulse_shape(self, t : np.ndarray, *params):
         raise NotImplementedError
@@ -62,20 +82,35 @@ class GaussianExp(PulseShape):
     def __init__(self, filepath) -> None:
         super().__init__()
         
-        self.parameters = np.loadtxt(filepath, skiprows = 1)
-        self.param_num = self.parameters.size
+        self.param_num = 2
+        self.set_params(np.loadtxt(filepath, skiprows = 1))
         self.param_bounds = ([1e-11, 0], [1e-9, 1e9])
 
-        # Pre-calculates values related to the pulse shape parameters. Only
-        # use if the parameters to be used are going to be kept constant
-        # for the lifetime of the class.
+        # Always use the constants pre-calculated from the stored parameters, 
+        # ignoring the parameters passed to `pulse_shape`. Only use if the 
+        # parameters to be used are going to be kept constant for the 
+        # lifetime of the class.
         self.make_performant = False
 
-        sigma_val, lambda_val = self.parameters
+    def set_params(self, new_params):
+        super().set_params(new_params)
+        self._consts = self._derived_constants(*self.param_tuple)
+        _, self.delta_t, self.h2 = self._consts
+
+    @staticmethod
+    def _derived_constants(sig: float, 
+                           lam: float) -> tuple[float, float, float]:
+        """
+        Returns the constants of the pulse shape that depend only on its 
+        parameters: the factor -1 / (2 sig^2) of the gaussian's exponent, and
+        the time `delta_t` and height `h2` at which the exponential tail 
+        starts.
+        """
         # Differentiability condition
-        self.delta_t = lambda_val * sigma_val**2 
+        delta_t = lam * sig**2 
         # Continuity condition
-        self.h2 = np.exp(-self.delta_t**2 / (2 * sigma_val**2)) 
+        h2 = np.exp(-delta_t**2 / (2 * sig**2)) 
+        return -0.5 / sig**2, delta_t, h2
 
     def pulse_shape(self, t : np.ndarray, *params) -> np.ndarray:        
         """
@@ -88,29 +123,44 @@ class GaussianExp(PulseShape):
         all set to optimal values determined by Anna for the shape of the pulse, 
         which are loaded form an external file.
         """
-        if self.make_performant:
-            sig, lam = self.parameters
-            delta_t = self.delta_t
-            h2 = self.h2
+        if self.make_performant or params == self.param_tuple:
+            _, lam = self.param_tuple
+            neg_inv_two_sig2, delta_t, h2 = self._consts
         else:
-            sig, lam = params
-            # Differentiability condition
-            delta_t = lam * sig**2 
-            # Continuity condition
-            h2 = np.exp(-delta_t**2 / (2 * sig**2)) 
-
-        step_function = np.heaviside(t - delta_t, h2)
-
-        gaussian = np.exp(-t**2 / (2 * sig**2))
-        exp_tail = h2 * np.exp(-lam * (t - delta_t))
-
-        # Optionally disable output validation check to save time.
-        if not self.make_performant:
-            if not np.all(np.isfinite(exp_tail)):
+            _, lam = params
+            neg_inv_two_sig2, delta_t, h2 = self._derived_constants(*params)
+
+        # Each part is only evaluated, in place, where it is used, rather than
+        # evaluating both everywhere and blending them with a step function.
+        t = np.asarray(t, dtype=np.float64)
+        pulse = np.empty_like(t)
+        # An array even for scalar `t`, so that it can be inverted in place.
+        mask = np.asarray(t < delta_t)
+
+        gaussian = t[mask]
+        np.square(gaussian, out=gaussian)
+        np.multiply(gaussian, neg_inv_two_sig2, out=gaussian)
+        np.exp(gaussian, out=gaussian)
+        pulse[mask] = gaussian
+
+        np.logical_not(mask, out=mask)
+        exp_tail = t[mask]
+        np.subtract(exp_tail, delta_t, out=exp_tail)
+        np.multiply(exp_tail, -lam, out=exp_tail)
+
+        # Optionally disable output validation check to save time. The tail is
+        # only evaluated after `delta_t`, so its exponent can only be positive,
+        # and overflow, if `lam` is negative.
+        if not self.make_performant and lam < 0 and exp_tail.size:
+            if exp_tail.max() > _MAX_EXP_ARG:
                 raise ValueError("Exponential overflow; input value is too "
                                 "extreme.")
+
+        np.exp(exp_tail, out=exp_tail)
+        np.multiply(exp_tail, h2, out=exp_tail)
+        pulse[mask] = exp_tail
  
-        return gaussian * (1 - step_function) + exp_tail * step_function
+        return pulse
 
     def norm_pulse_shape(self, t: np.ndarray, *params):
         """
@@ -127,30 +177,140 @@ class Lorentzian(PulseShape):
 
         GAMMA = 4e-10
         LAMBDA = 500000000
-        self.parameters = GAMMA, LAMBDA
+        self.param_num = 2
+        self.set_params((GAMMA, LAMBDA))
 
-    def pulse_shape(self, t : np.ndarray, *params) -> np.ndarray:
+        # Always use the constants pre-calculated from the stored parameters, 
+        # ignoring the parameters passed to `pulse_shape` (see `GaussianExp`).
+        self.make_performant = False
+
+    def set_params(self, new_params):
+        super().set_params(new_params)
+        self._consts = self._derived_constants(*self.param_tuple)
+
+    @staticmethod
+    def _derived_constants(gamma: float, 
+                           lam: float) -> tuple[float, float, float, float]:
         """
-        Similar to the gaussian pulse with an exponential tail 
-        `modified_gaussian_exp`, but the pulse has a lorenzian shape, while the 
-        tail is still exponential. 
+        Returns the constants of the pulse shape that depend only on its 
+        parameters: 1 / gamma and 1 / (pi gamma) for the lorentzian, and the 
+        time `delta_t` and height `h2` at which the exponential tail starts.
         """
-        gamma, lam = params
-        
         if 1 < (gamma * lam)**2:
             raise ValueError("Invalid parameter input.")
 
+        inv_gamma = 1 / gamma
+        inv_pi_gamma = 1 / (np.pi * gamma)
         # Differentiability condition   
         delta_t = 1 / lam + np.sqrt(1 / (lam**2) - gamma**2)
         # Continuity condition
-        h2 = 1 / (np.pi * gamma * (1 + (delta_t / gamma)**2))
-        # Defines which part of the function is defined where.
-        step_function  = np.heaviside(t - delta_t, h2) 
+        h2 = inv_pi_gamma / (1 + (delta_t * inv_gamma)**2)
+        return inv_gamma, inv_pi_gamma, delta_t, h2
+
+    def pulse_shape(self, t : np.ndarray, *params) -> np.ndarray:
+        """
+        Similar to the gaussian pulse with an exponential tail 
+        `modified_gaussian_exp`, but the pulse has a lorenzian shape, while the 
+        tail is still exponential. 
+        """
+        if self.make_performant or params == self.param_tuple:
+            _, lam = self.param_tuple
+            inv_gamma, inv_pi_gamma, delta_t, h2 = self._consts
+        else:
+            _, lam = params
+            inv_gamma, inv_pi_gamma, delta_t, h2 = \
+                self._derived_constants(*params)
+
+        # Defines which part of the function is defined where; each part is 
+        # only evaluated where it is used, in place in the selected values.
+        t = np.asarray(t, dtype=np.float64)
+        pulse = np.empty_like(t)
+        # An array even for scalar `t`, so that it can be inverted in place.
+        mask = np.asarray(t < delta_t)
+
+        lorentzian = t[mask]
+        np.multiply(lorentzian, inv_gamma, out=lorentzian)
+        np.square(lorentzian, out=lorentzian)
+        np.add(lorentzian, 1, out=lorentzian)
+        np.divide(inv_pi_gamma, lorentzian, out=lorentzian)
+        pulse[mask] = lorentzian
+
+        np.logical_not(mask, out=mask)
+        exp_tail = t[mask]
+        np.subtract(exp_tail, delta_t, out=exp_tail)
+        np.multiply(exp_tail, -lam, out=exp_tail)
+        np.exp(exp_tail, out=exp_tail)
+        np.multiply(exp_tail, h2, out=exp_tail)
+        pulse[mask] = exp_tail
+
+        return pulse
+
+
+class EMGPulse(PulseShape):
+    """
+    Inherits from PulseShape. This pulse shape is an exponentially modified
+    gaussian: a gaussian convolved with an exponential decay. Like
+    `GaussianExp` it is a gaussian with an exponential tail, but the two are
+    joined smoothly by a single expression rather than piecewise, so its
+    parameters are not interchangeable with those of `GaussianExp`, and the
+    pulse parameter files do not apply to it.
+    """
+
+    def __init__(self, sig: float, lam: float) -> None:
+        super().__init__()
+
+        self.param_num = 2
+        self.set_params((sig, lam))
+
+    def set_params(self, new_params):
+        super().set_params(new_params)
+        self._peak = self._peak_value(*self.param_tuple)
+
+    def pulse_shape(self, t : np.ndarray, *params) -> np.ndarray:
+        """
+        Exponentially modified gaussian with gaussian width `sig` and tail
+        decay rate `lam`, centred on t = 0,
+
+            lam / 2 exp(lam (lam sig^2 / 2 - t)) erfc((lam sig^2 - t) /
+                                                       (sqrt(2) sig)),
+
+        evaluated through the log of the normal CDF, since erfc = 2 ndtr(-x
+        sqrt(2)), so that the exponential cannot overflow where the erfc
+        underflows.
+        """
+        sig, lam = params
 
-        lorenzian = 1 / (np.pi * gamma * (1 + (t / gamma)**2))
-        exp_tail = h2 * np.exp(-lam * (t - delta_t))
+        from scipy.special import log_ndtr
+
+        t = np.asarray(t, dtype=np.float64)
+        log_cdf = log_ndtr((t - lam * sig**2) / sig)
+        return lam * np.exp(log_cdf + lam * (0.5 * lam * sig**2 - t))
+
+    def norm_pulse_shape(self, t: np.ndarray, *params):
+        """
+        Override this function, since the peak of the pulse is not at t = 0.
+        """
+        if params == self.param_tuple:
+            peak = self._peak
+        else:
+            peak = self._peak_value(*params)
+        return self.pulse_shape(t, *params) / peak
+
+    def _peak_value(self, sig: float, lam: float) -> float:
+        """
+        Returns the maximum value of the pulse, which has no closed form. The
+        peak lies between the centre of the gaussian, t = 0, and the mean of 
+        the pulse, t = 1 / lam.
+        """
+        from scipy.optimize import minimize_scalar
 
-        return lorenzian * (1 - step_function) + exp_tail * step_function
+        scale = min(sig, 1 / lam)
+        res = minimize_scalar(
+            lambda t: -self.pulse_shape(t * scale, sig, lam), 
+            bounds=(0, 1 / (lam * scale)), method='bounded',
+            options={'xatol': 1e-8}
+        )
+        return -res.fun
 
 
 class Logistic(PulseShape):
@@ -163,8 +323,10 @@ class Logistic(PulseShape):
 
     def pulse_shape(self, t : np.ndarray, *params):
         
-        s = params
-        return 1 / np.cosh(t / (2 * s))**2
+        s, = params
+        # sech^2(x) = 1 - tanh^2(x), which unlike cosh(x)**2 cannot overflow.
+        th = np.tanh(np.multiply(t, 0.5 / s))
+        return (1 - th) * (1 + th)
 
 class LogNormal(PulseShape):
 
@@ -178,11 +340,10 @@ class LogNormal(PulseShape):
         
         a, b = params
         
-        if type(t) is not np.ndarray:
-            t = np.array(t)
+        t = np.asarray(t)
         
         start_point = -1 / a    
-        valid_time_idxs = np.vectorize(lambda x : start_point < x)(t)
+        valid_time_idxs = start_point < t
         valid_t = t[valid_time_idxs]
 
         log_normal = np.zeros(shape=t.shape)
@@ -1,15 +1,287 @@
-import os, sys, inspect
+import os, sys, inspect, pickle, argparse
 this_dir = os.path.abspath(inspect.getfile(inspect.currentframe()))
 parent_dir = os.path.dirname(os.path.dirname(this_dir))
 sys.path.insert(0, os.path.join(parent_dir, "src"))
 
-from main_funcs import fit_trace
+import numpy as np
+import pytest
+from scipy.special import erfc
+
+import main_funcs
+from main_funcs import fit_trace, CommandHandler
+from burst_function import BurstFunction
+from data_trace import DataTrace
+from fitter import Fitter, FitQualityWarning
+from io_functions import (LeCroyLoader, OutputHandler, load_pickled_obj,
+                          PICKLE_BUFFERS_EXT)
+from pulse_profiles import GaussianExp, Lorentzian, EMGPulse
 from constants import *
 
 
 def test_example():
     pass
 
+def test_tau_function():
+    n_vals = np.arange(0, 12)
+    expected = np.tile([0, TAU_1, TAU_2, TAU_3], 3)
+    assert np.array_equal(BurstFunction.tau_function(n_vals), expected)
+
+    bfunc = BurstFunction(0., 12, TraceType.PUMP)
+    assert np.allclose(bfunc.get_time_from_pulses(n_vals),
+                       PERIOD * (n_vals // 4) + expected)
+
+def test_burst_function():
+    bfunc = BurstFunction(0., 40, TraceType.PUMP)
+    times = np.linspace(bfunc.t_start, bfunc.t_end, 10_000)
+    amplitudes = np.linspace(0.1, 0.2, 40)
+
+    expected = bfunc.get_pulse_matrix(times).dot(amplitudes)
+    assert np.allclose(bfunc.burst_function(times, amplitudes), expected)
+
+    out = np.zeros_like(times)
+    assert bfunc.burst_function(times, amplitudes, out=out) is out
+    assert np.allclose(out, expected)
+
+def test_pulse_shapes():
+    # Compare against the original forms of the pulse shapes, which blend
+    # both branches everywhere with a step function.
+    times = np.linspace(-5e-9, 5e-9, 1001)
+
+    gexp = GaussianExp(PULSE_PARAM_IDX[TraceType.PUMP])
+    sig, lam = gexp.param_tuple
+    delta_t = lam * sig**2
+    h2 = np.exp(-delta_t**2 / (2 * sig**2))
+    step = np.heaviside(times - delta_t, h2)
+    expected = np.exp(-times**2 / (2 * sig**2)) * (1 - step) + \
+               h2 * np.exp(-lam * (times - delta_t)) * step
+    assert np.allclose(gexp.pulse_shape(times, sig, lam), expected)
+    assert gexp.pulse_shape(0.0, sig, lam) == 1.0
+
+    lorentz = Lorentzian()
+    gamma, lam = lorentz.param_tuple
+    delta_t = 1 / lam + np.sqrt(1 / (lam**2) - gamma**2)
+    h2 = 1 / (np.pi * gamma * (1 + (delta_t / gamma)**2))
+    expected = np.where(times < delta_t,
+                        1 / (np.pi * gamma * (1 + (times / gamma)**2)),
+                        h2 * np.exp(-lam * (times - delta_t)))
+    assert np.allclose(lorentz.pulse_shape(times, gamma, lam), expected)
+    assert np.isclose(lorentz.pulse_shape(0.0, gamma, lam), 1 / (np.pi * gamma))
+
+def test_emg_pulse():
+    sig, lam = 4.7e-10, 5.5e8
+    emg = EMGPulse(sig, lam)
+    times = np.linspace(-5e-9, 2e-8, 100_001)
+    expected = lam / 2 * np.exp(lam / 2 * (lam * sig**2 - 2 * times)) * \
+               erfc((lam * sig**2 - times) / (np.sqrt(2) * sig))
+    assert np.allclose(emg.pulse_shape(times, sig, lam), expected)
+    assert np.all(np.isfinite(emg.pulse_shape(np.array([-1e-6, 1e-6]), 
+                                              sig, lam)))
+
+    # Normalized by its peak, which is not at t = 0.
+    norm_pulse = emg.norm_pulse_shape(times, sig, lam)
+    assert np.isclose(norm_pulse.max(), 1.0)
+    assert norm_pulse.max() <= 1.0 + 1e-9
+    assert np.allclose(emg.norm_pulse_shape(times, 1e-9, 1e9), 
+                       EMGPulse(1e-9, 1e9).norm_pulse_shape(times, 1e-9, 1e9))
+
+def test_batch_regression():
+    bfunc = BurstFunction(0., 8, TraceType.PUMP)
+    times = np.linspace(bfunc.t_start, bfunc.t_end, 500)
+    amplitudes = np.random.default_rng(0).uniform(0.1, 0.2, (3, 8))
+    dtraces = [DataTrace(times, bfunc.burst_function(times, ampls))
+               for ampls in amplitudes]
+
+    fitter = Fitter("batch")
+    batch_results = fitter.linear_regress_burst_batch(dtraces, bfunc)
+    for dtrace, ampls, results in zip(dtraces, amplitudes, batch_results):
+        single_results = fitter.linear_regress_burst_fast(dtrace, bfunc)
+        assert np.allclose(results.params, ampls)
+        assert np.allclose(results.params, single_results.params)
+        assert np.isclose(results.rsquared, single_results.rsquared)
+
+def test_chi2_stats():
+    bfunc = BurstFunction(0., 8, TraceType.PUMP)
+    times = np.linspace(bfunc.t_start, bfunc.t_end, 500)
+    noise = np.random.default_rng(0).normal(0, 0.01, times.shape)
+    dtrace = DataTrace(times, bfunc.burst_function(times, np.ones(8)) + noise)
+
+    fitter = Fitter("chi2")
+    fitter.linear_regress_burst_fast(dtrace, bfunc)
+    assert np.allclose(fitter.get_chi2_stats(0.01),
+                       fitter.get_chi2_stats(np.full(times.shape, 0.01)))
+
+def test_make_restricted():
+    times = np.linspace(0, 1, 101)
+    dtrace = DataTrace(times, times ** 2)
+    res_trace = dtrace.make_restricted(0.25, 0.5)
+    assert np.array_equal(res_trace.get_time_values(), times[25:51])
+    assert np.array_equal(res_trace.get_data_values(), times[25:51] ** 2)
+
+    shuffled = DataTrace(times[::-1], times[::-1] ** 2)
+    res_trace = shuffled.make_restricted(0.25, 0.5)
+    assert np.array_equal(res_trace.get_time_values(), times[25:51][::-1])
+
+    assert dtrace.get_time_range() == (0, 1)
+    assert shuffled.get_time_range() == (0, 1)
+
+def _write_lecroy_csv(fpath, time_values, data_values):
+    with open(fpath, 'w') as file:
+        file.write("LECROYWS3054,16387,Waveform\nSegments,1,SegmentSize,2002\n"
+                   "Segment,TrigTime,TimeSinceSegment1\n"
+                   "#1,27-Jul-2023 02:51:36,0\nTime,Ampl\n")
+        file.writelines(f"{t:.6e},{v:.6e}\n" 
+                        for t, v in zip(time_values, data_values))
+
+def test_trace_cache(tmp_path):
+    fpath = str(tmp_path / "trace.csv")
+    times = np.linspace(-1e-7, 1e-7, 101)
+    _write_lecroy_csv(fpath, times, times * 1e5)
+
+    # Cache miss: the trace is parsed and cached.
+    dtrace = LeCroyLoader.load_trace(fpath)
+    assert os.path.exists(fpath + ".npy")
+    assert np.allclose(dtrace.get_data_values(), times * 1e5)
+
+    # Cache hit: the cached values are memory-mapped, so read-only.
+    dtrace = LeCroyLoader.load_trace(fpath)
+    assert not dtrace.get_data_values().flags.writeable
+    assert np.allclose(dtrace.get_data_values(), times * 1e5)
+
+    # A different trace copied in with an older modification time (e.g. by
+    # `cp -p`) invalidates the cache.
+    csv_stat = os.stat(fpath)
+    _write_lecroy_csv(fpath, times, times * -1e5)
+    os.utime(fpath, ns=(csv_stat.st_atime_ns, csv_stat.st_mtime_ns - 10**9))
+    dtrace = LeCroyLoader.load_trace(fpath)
+    assert np.allclose(dtrace.get_data_values(), times * -1e5)
+    assert np.allclose(LeCroyLoader.load_trace(fpath).get_data_values(),
+                       times * -1e5)
+
+def test_pickle_round_trip(tmp_path):
+    times = np.linspace(0, 1, 101)
+    obj = {'trace': DataTrace(times, times ** 2), 'params': np.arange(8.)}
+
+    handler = OutputHandler(str(tmp_path))
+    handler.pickle_obj("fits.pickle", obj)
+    pickle_path = str(tmp_path / "fits.pickle")
+    loaded = load_pickled_obj(pickle_path)
+    assert np.array_equal(loaded['params'], obj['params'])
+    assert np.array_equal(loaded['trace'].get_data_values(), times ** 2)
+
+    # The array data is kept in the buffers file, which must not be 
+    # overwritten, and is required to load the pickle file.
+    os.remove(pickle_path)
+    with pytest.raises(RuntimeError):
+        handler.pickle_obj("fits.pickle", obj)
+
+    handler.pickle_obj("other.pickle", obj)
+    os.remove(str(tmp_path / "other.pickle") + PICKLE_BUFFERS_EXT)
+    with pytest.raises(FileNotFoundError):
+        load_pickled_obj(str(tmp_path / "other.pickle"))
+
+    # Plain pickle files are still loaded.
+    with open(pickle_path, 'wb') as file:
+        pickle.dump(obj, file)
+    assert np.array_equal(load_pickled_obj(pickle_path)['params'], 
+                          obj['params'])
+
+def test_load_old_pickle(tmp_path):
+    import matplotlib
+    matplotlib.use("Agg")
+    from plotting import plot_graphs_together
+
+    bfunc = BurstFunction(0., 8, TraceType.PUMP)
+    times = np.linspace(bfunc.t_start, bfunc.t_end, 500)
+    noise = np.random.default_rng(0).normal(0, 0.01, times.shape)
+    dtrace = DataTrace(times, bfunc.burst_function(times, np.ones(8)) + noise)
+    fit = Fitter("old").linear_regress_burst(dtrace, bfunc)
+
+    # Strip the attributes added since the first version of this program, 
+    # to pickle the objects as that version did.
+    del dtrace._is_sorted
+    for attr in ['dtype', '_total_tshift', '_pulse_times']:
+        delattr(bfunc, attr)
+    for attr in ['param_tuple', '_consts']:
+        delattr(bfunc.pulse_shape, attr)
+    pickle_path = str(tmp_path / "old.pickle")
+    with open(pickle_path, 'wb') as file:
+        pickle.dump({'fit_results': fit, 'data_trc': dtrace, 
+                     'burst_model': bfunc}, file)
+
+    loaded = load_pickled_obj(pickle_path)
+    fit, dtrace, bfunc = loaded.values()
+    assert np.allclose(bfunc.burst_function(times, fit.params), 
+                       fit.fittedvalues)
+    assert dtrace.get_time_range() == (times[0], times[-1])
+    plot_graphs_together(dtrace, fit, bfunc)
+
+def _batch_fit(data_dir, manifest_lines, **options):
+    """
+    Writes `manifest_lines` to a manifest file in `data_dir`, fits the files
+    it lists with `CommandHandler.batch_fit`, and returns the amplitudes 
+    saved to the output file.
+    """
+    manifest = os.path.join(data_dir, "manifest.csv")
+    with open(manifest, 'w') as file:
+        file.write("\n".join(manifest_lines) + "\n")
+
+    out_dir = os.path.join(data_dir, "out")
+    os.makedirs(out_dir, exist_ok=True)
+    handler = CommandHandler()
+    handler.create_file_handler(out_dir, True)
+    args = argparse.Namespace(file_manifest=manifest, get_t0_from_meta=False,
+                              t0_value=0., data_path=data_dir, n_pulses=8,
+                              plot=False, verbose=False, pickle=False)
+    vars(args).update(options)
+    handler.batch_fit(args)
+    return np.loadtxt(os.path.join(out_dir, "trace-amplitudes.csv"), 
+                      delimiter=',', ndmin=2)
+
+def test_batch_fit_pool(tmp_path, monkeypatch):
+    bfunc = BurstFunction(0., 8, TraceType.PUMP)
+    times = np.linspace(bfunc.t_start, bfunc.t_end, 2000)
+    rng = np.random.default_rng(0)
+    for idx in range(4):
+        data = bfunc.burst_function(times, rng.uniform(0.5, 1, 8))
+        _write_lecroy_csv(str(tmp_path / f"trace{idx}.csv"), times, 
+                          data + rng.normal(0, 0.01, times.shape))
+    _write_lecroy_csv(str(tmp_path / "noise.csv"), times, 
+                      rng.normal(0, 0.01, times.shape))
+    manifest = [f"trace{idx}.csv,PUMP" for idx in range(4)]
+
+    # The files are fitted by a pool of workers given more than 2 cores.
+    monkeypatch.setattr(os, "cpu_count", lambda: 1)
+    serial_ampls = _batch_fit(str(tmp_path), manifest)
+    monkeypatch.setattr(os, "cpu_count", lambda: 8)
+    pool_ampls = _batch_fit(str(tmp_path), manifest)
+    assert serial_ampls.shape == (8, 4)
+    assert np.array_equal(pool_ampls, serial_ampls)
+
+    # A failed fit in a worker is shown from the main process.
+    shown = []
+    monkeypatch.setattr(main_funcs, "show_figures", 
+                        lambda *args: shown.append(args))
+    with pytest.raises(FitQualityWarning) as err_info:
+        _batch_fit(str(tmp_path), manifest[:2] + ["noise.csv,PUMP"])
+    assert err_info.value.figure_args[-1] == "noise"
+    assert shown == [err_info.value.figure_args]
+
+def test_batch_fit_manifest(tmp_path):
+    bfunc = BurstFunction(0., 8, TraceType.PUMP)
+    times = np.linspace(bfunc.t_start, bfunc.t_end, 2000)
+    noise = np.random.default_rng(0).normal(0, 0.01, times.shape)
+    _write_lecroy_csv(str(tmp_path / "trace.csv"), times, 
+                      bfunc.burst_function(times, np.ones(8)) + noise)
+
+    expected = _batch_fit(str(tmp_path), ["trace.csv,PUMP"])
+    assert expected.shape == (8, 1)
+
+    manifest = ["# filename, trace type, t0", "", 
+                "  trace.csv , PUMP ,0.  # a comment", "   # indented comment"]
+    ampls = _batch_fit(str(tmp_path), manifest, get_t0_from_meta=True, 
+                       t0_value=main_funcs.NoT0Val())
+    assert np.array_equal(ampls, expected)
+
 if __name__ == "__main__":
 
     test_example()